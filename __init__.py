@@ -5,6 +5,7 @@ import gdb
 
 from .tvm_pretty_print import PrettyPrinter, PrettyPrintLevel
 from .frame_filter import FrameFilter, FilterLevel
+from .utils import disconnect_events
 
 
 def parse(cls, string):
@@ -15,10 +16,10 @@ def parse(cls, string):
     else:
         return cls(as_int)
 
+    members = cls.__members__
     output = cls.Disabled
     for part in string.split("|"):
-        part = cls[part.strip().capitalize()]
-        output = output | part
+        output |= members[part.strip().capitalize()]
     return output
 
 
@@ -30,9 +31,29 @@ def env_var_flag(cls, env_var):
         return cls.Default
 
 
+def _remove_frame_filters():
+    # Remove any filters registered by a previous source of this
+    # extension, including filters that no longer exist.
+    for name in list(gdb.frame_filters):
+        if name.startswith("TVM_"):
+            del gdb.frame_filters[name]
+
+
+def unload():
+    """Undo the registrations made by main() and by importing the extension
+
+    Called by source-me.py before re-sourcing, so that the previous
+    version's event handlers do not stay connected.
+    """
+    disconnect_events()
+    _remove_frame_filters()
+    PrettyPrinter.unregister()
+
+
 def main():
     filter_level = env_var_flag(FilterLevel, "TVM_GDB_FILTER_LEVEL")
     pprint_level = env_var_flag(PrettyPrintLevel, "TVM_GDB_PRETTY_PRINT")
 
+    _remove_frame_filters()
     FrameFilter.register(filter_level)
     PrettyPrinter.register(pprint_level)
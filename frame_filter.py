@@ -5,7 +5,7 @@ Usage:
 
 - Install debug symbols for python.  (e.g. `sudo apt install pythonX.Y-dbg`)
 - Source this file in your `.gdbinit`
-  `source ~/path/to/the/tvm_packedfunc_filter.py`
+  `source ~/path/to/the/tvm-gdb-extension/source-me.py`
 
 """
 
@@ -16,14 +16,61 @@ import os
 import re
 
 from abc import abstractmethod
-from typing import Union
 
-from .utils import _unwrap_frame, StacktraceOnRaise
+from .utils import (
+    _cached_parse_and_eval,
+    _unwrap_frame,
+    connect_event,
+    stacktrace_on_raise,
+)
 
 import gdb
 from gdb.FrameDecorator import FrameDecorator
 
 
+_RE_PYTHON_EXE = re.compile(r"^python\d+\.\d+d?$")
+_RE_LIBPYTHON = re.compile(r"^libpython\d+\.\d+d?\.so(\.\d)*$")
+_RE_LIBFFI = re.compile(r"^libffi\.so(\.\d)*$")
+
+_RE_FUNCTOR = re.compile(
+    "|".join(
+        [
+            r"tvm::.*Functor<.*>::operator\(\)",
+            r"tvm::.*Functor<.*>::Visit",
+            r"tvm::.*Functor<.*>::InitVTable",
+            r"tvm::tir::StmtExprVisitor::VisitExpr",
+            r"tvm::tir::StmtExprMutator::VisitExpr",
+        ]
+    )
+)
+
+_RE_VISITOR = re.compile(
+    r"(((Expr|Stmt)(Visitor|Mutator))|(IR(Visitor|Mutator)WithAnalyzer))::Visit(Stmt|Expr)_"
+)
+
+_TRANSFORM_BASE_FUNCS = frozenset(
+    [
+        "tvm::tir::transform::PrimFuncPassNode::operator()(tvm::IRModule, tvm::transform::PassContext const&) const",
+        "tvm::transform::Pass::operator()(tvm::IRModule, tvm::transform::PassContext const&) const",
+        "tvm::transform::SequentialNode::operator()(tvm::IRModule, tvm::transform::PassContext const&) const",
+        "tvm::transform::Pass::operator()(tvm::IRModule) const",
+    ]
+)
+
+
+# Whether any python object file is loaded.  Checked lazily, and
+# re-checked after new object files are loaded.
+_python_loaded = None
+
+
+def _reset_python_loaded(event=None):
+    global _python_loaded
+    _python_loaded = None
+
+
+connect_event(gdb.events.new_objfile, _reset_python_loaded)
+
+
 class FilterLevel(enum.Flag):
     Disabled = 0
     Interpreter = enum.auto()
@@ -37,63 +84,129 @@ class FilterLevel(enum.Flag):
 class FrameFilter:
     @classmethod
     def register(cls, filter_level):
+        # Disabled filters are not registered at all, since gdb would
+        # still need to check each of them on every stack trace.  Any
+        # left over from sourcing this extension previously are removed.
         for subclass in cls._filters:
-            filter = subclass()
-            filter.enabled = filter_level & subclass.filter_level
-            gdb.frame_filters[filter.name] = filter
+            if filter_level & subclass.filter_level:
+                filter = subclass()
+                filter.configure(filter_level)
+                gdb.frame_filters[filter.name] = filter
+            else:
+                gdb.frame_filters.pop(subclass.name, None)
 
     _filters = []
 
-    def __init_subclass__(cls, /, filter_level, priority=100, **kwargs):
+    def __init_subclass__(cls, /, filter_level, priority=100, name=None, **kwargs):
         super().__init_subclass__(**kwargs)
         cls.filter_level = filter_level
         cls.priority = priority
+        cls.name = name or "TVM_" + cls.__name__
         FrameFilter._filters.append(cls)
 
     def __init__(self):
-        self.name = "TVM_" + type(self).__name__
+        self.name = type(self).name
         self.priority = type(self).priority
         self.enabled = True
 
+    def configure(self, filter_level):
+        """Adjust an enabled filter to the requested filter level"""
 
-class PythonFrameFilter(FrameFilter, filter_level=FilterLevel.Interpreter):
+
+class PythonFrameFilter(
+    FrameFilter, filter_level=FilterLevel.Interpreter, name="TVM_Python_Filter"
+):
     def __init__(self):
-        self.name = "TVM_Python_Filter"
-        self.priority = 100
-        self.enabled = True
+        super().__init__()
+        self._prog_name = None
+        self._is_python_cache = {}
+
+        # Handlers for each frame, indexed by
+        # (is_python << 2) | (is_evalframe << 1) | (prev_evalframe is not None).
+        # Only python frames can be eval frames, so 2 and 3 are unreachable.
+        self._transitions = [
+            self._non_python_frame,
+            self._end_of_python_frames,
+            None,
+            None,
+            self._python_frame,
+            self._python_frame,
+            self._first_evalframe,
+            self._next_evalframe,
+        ]
 
     def filter(self, frame_iter):
-        with StacktraceOnRaise():
+        with stacktrace_on_raise:
+            # The object file containing a frame is looked up for
+            # every frame, but only a handful of distinct object files
+            # appear in any one stack trace.  Cache per stack trace,
+            # since libraries may be loaded/unloaded between them.
+            self._prog_name = gdb.current_progspace().filename
+            self._is_python_cache = {}
+
+            # Without python loaded, there are no frames to combine.
+            if not self.python_loaded():
+                yield from frame_iter
+                return
+
             python_frames = []
             prev_evalframe = None
 
+            transitions = self._transitions
             for frame in frame_iter:
                 is_python = self.is_python_frame(frame)
                 is_evalframe = is_python and self.is_python_evalframe(frame)
+                state = (
+                    (is_python << 2)
+                    | (is_evalframe << 1)
+                    | (prev_evalframe is not None)
+                )
+                output, python_frames, prev_evalframe = transitions[state](
+                    frame, python_frames, prev_evalframe
+                )
+                yield from output
+
+    def python_loaded(self):
+        """Check if any object file owned by CPython is loaded"""
+        global _python_loaded
+        if _python_loaded is None:
+            _python_loaded = any(
+                self.is_python_object_file(objfile.filename)
+                for objfile in gdb.objfiles()
+                if objfile.filename
+            )
+        return _python_loaded
+
+    # Each handler receives the current frame, along with the python
+    # frames collected so far and the eval frame that started them.
+    # It returns the frames to output, and the updated state.
 
-                if is_python and is_evalframe and prev_evalframe is None:
-                    prev_evalframe = frame
-                    python_frames.append(frame)
-                elif is_python and is_evalframe and prev_evalframe is not None:
-                    yield PythonFrameDecorator(prev_evalframe, python_frames)
-                    python_frames = [frame]
-                    prev_evalframe = frame
-                elif is_python and not is_evalframe:
-                    python_frames.append(frame)
-                elif not is_python and python_frames and prev_evalframe is not None:
-                    yield PythonFrameDecorator(prev_evalframe, python_frames)
-                    python_frames = []
-                    prev_evalframe = None
-                    yield frame
-                elif not is_python and python_frames and prev_evalframe is None:
-                    yield from python_frames
-                    python_frames = []
-                    yield frame
-                elif not is_python and not python_frames:
-                    yield frame
+    @staticmethod
+    def _non_python_frame(frame, python_frames, prev_evalframe):
+        # Python frames with no eval frame are passed through as-is.
+        return [*python_frames, frame], [], None
+
+    @staticmethod
+    def _end_of_python_frames(frame, python_frames, prev_evalframe):
+        output = [PythonFrameDecorator(prev_evalframe, python_frames), frame]
+        return output, [], None
 
     @staticmethod
-    def is_python_frame(frame):
+    def _python_frame(frame, python_frames, prev_evalframe):
+        python_frames.append(frame)
+        return (), python_frames, prev_evalframe
+
+    @staticmethod
+    def _first_evalframe(frame, python_frames, prev_evalframe):
+        python_frames.append(frame)
+        return (), python_frames, frame
+
+    @staticmethod
+    def _next_evalframe(frame, python_frames, prev_evalframe):
+        output = (PythonFrameDecorator(prev_evalframe, python_frames),)
+        return output, [frame], frame
+
+    def is_python_frame(self, frame):
         """Check if this stack frame is owned by CPython
 
         Returns True if the stack frame is part of the python
@@ -107,22 +220,32 @@ class PythonFrameFilter(FrameFilter, filter_level=FilterLevel.Interpreter):
         # Find the file that contains the current instruction pointer.
 
         shared_lib_name = gdb.solib_name(frame.pc())
-        prog_name = gdb.current_progspace().filename
         if shared_lib_name:
             obj_filepath = shared_lib_name
         else:
-            obj_filepath = prog_name
+            obj_filepath = self._prog_name
+
+        is_python = self._is_python_cache.get(obj_filepath)
+        if is_python is None:
+            is_python = self.is_python_object_file(obj_filepath)
+            self._is_python_cache[obj_filepath] = is_python
+
+        return is_python
+
+    @staticmethod
+    def is_python_object_file(obj_filepath):
+        """Check if this object file is owned by CPython"""
 
         obj_filename = os.path.basename(obj_filepath)
 
         # Check for pythonX.Y, and debug versions pythonX.Yd
-        is_python_exe = bool(re.match(r"^python\d+\.\d+d?$", obj_filename))
+        is_python_exe = bool(_RE_PYTHON_EXE.match(obj_filename))
         # Check for libpythonX.Y.so, libpythonX.Yd.so, with optional versioning
-        is_libpython = bool(re.match(r"^libpython\d+\.\d+d?\.so(\.\d)*$", obj_filename))
+        is_libpython = bool(_RE_LIBPYTHON.match(obj_filename))
         # Check for cpython compiled modules (e.g. _ctypes.cpython-38-x86_64-linux-gnu.so)
         is_cpython_module = "cpython" in obj_filename
         # Check for libffi.so, with optional versioning
-        is_ffi = bool(re.match(r"^libffi.so(\.\d)*$", obj_filename))
+        is_ffi = bool(_RE_LIBFFI.match(obj_filename))
 
         is_python = is_python_exe or is_libpython or is_cpython_module or is_ffi
 
@@ -148,8 +271,9 @@ class PythonFrameDecorator(FrameDecorator):
         self.frame = evalframe
         self.gdbframe = _unwrap_frame(evalframe)
         self._elided = frames
+        self._pyframe_info = None
 
-    @StacktraceOnRaise()
+    @stacktrace_on_raise
     def elided(self):
         return self._elided
 
@@ -172,35 +296,83 @@ class PythonFrameDecorator(FrameDecorator):
         self._pyop = pyframe.get_pyop()
         return self._pyop
 
-    @StacktraceOnRaise()
+    def _read_pyframe(self, pyframe):
+        """Read the filename, function name, and line number of a PyFrameObject*
+
+        The inferior functions are resolved once and called as
+        gdb.Value objects, rather than parsing a new expression for
+        each frame.
+        """
+        if self._pyframe_info is not None:
+            return self._pyframe_info
+
+        as_utf8 = _cached_parse_and_eval("PyUnicode_AsUTF8")
+        # The cast of the PyFrame_GetLineNumber function pointer is a
+        # workaround for incorrect debug symbols (observed in
+        # python3.7-dbg in ubuntu 18.04, PyFrame_GetLineNumber showed
+        # 4 arguments instead of 1).
+        get_line_number = _cached_parse_and_eval(
+            "*(int (*)(PyFrameObject*))PyFrame_GetLineNumber"
+        )
+
+        code = pyframe["f_code"]
+        self._pyframe_info = (
+            as_utf8(code["co_filename"]).string(),
+            as_utf8(code["co_name"]).string(),
+            int(get_line_number(pyframe)),
+        )
+        return self._pyframe_info
+
+    @stacktrace_on_raise
     def get_pyframe_argument(self):
+        if hasattr(self, "_pyframe_ptr"):
+            return self._pyframe_ptr
+
+        self._pyframe_ptr = self._find_pyframe_argument()
+        return self._pyframe_ptr
+
+    def _find_pyframe_argument(self):
         frames_to_check = [self.gdbframe, self.gdbframe.older()]
 
-        def symbols(frame):
+        def is_pyframe_pointer(type_):
+            return (
+                type_.code == gdb.TYPE_CODE_PTR
+                and type_.target().name == "PyFrameObject"
+            )
+
+        def values(frame):
+            # Before 3.11, CPython's eval loop names its PyFrameObject*
+            # argument "f".  Look that up by name first, and only scan
+            # all arguments and locals if that fails.  The lookup falls
+            # back to globals, so only accept a function argument.
+            try:
+                sym, _ = gdb.lookup_symbol("f", frame.block())
+            except RuntimeError:
+                sym = None
+            if sym is not None and sym.is_argument:
+                yield sym.value(frame)
+
             frame_vars = gdb.FrameDecorator.FrameVars(frame)
             for wrapper in frame_vars.fetch_frame_args():
-                yield wrapper.sym
+                if is_pyframe_pointer(wrapper.sym.type):
+                    yield wrapper.sym.value(frame)
             for wrapper in frame_vars.fetch_frame_locals():
-                yield wrapper.sym
+                if is_pyframe_pointer(wrapper.sym.type):
+                    yield wrapper.sym.value(frame)
 
         for frame in frames_to_check:
-            for sym in symbols(frame):
-                if str(sym.type) == "PyFrameObject *":
-                    val = sym.value(frame)
-                    if not val.is_optimized_out:
-                        pointer = int(val)
-                        return pointer
+            for val in values(frame):
+                if is_pyframe_pointer(val.type) and not val.is_optimized_out:
+                    return val
 
         return None
 
-    @StacktraceOnRaise()
+    @stacktrace_on_raise
     def filename(self):
         pyframe = self.get_pyframe_argument()
         if pyframe is not None:
-            result = gdb.parse_and_eval(
-                f"PyUnicode_AsUTF8(((PyFrameObject*){pyframe})->f_code->co_filename)"
-            )
-            return result.string()
+            filename, _, _ = self._read_pyframe(pyframe)
+            return filename
 
         if self.pyop is not None:
             return self.pyop.filename()
@@ -224,21 +396,16 @@ class PythonFrameDecorator(FrameDecorator):
         pyframe = self.get_pyframe_argument()
         if pyframe is not None:
             # Call PyFrame_GetLineNumber in the inferior, using whichever
-            # pointer was found as an argument.  The cast of the function
-            # pointer is a workaround for incorrect debug symbols
-            # (observed in python3.7-dbg in ubuntu 18.04,
-            # PyFrame_GetLineNumber showed 4 arguments instead of 1).
-            line_num = gdb.parse_and_eval(
-                f"((int (*)(PyFrameObject*))PyFrame_GetLineNumber)((PyFrameObject*){pyframe})"
-            )
-            return int(line_num)
+            # pointer was found as an argument.
+            _, _, line_num = self._read_pyframe(pyframe)
+            return line_num
 
         if self.pyop is not None:
             return self.pyop.f_lineno
 
         return None
 
-    @StacktraceOnRaise()
+    @stacktrace_on_raise
     def frame_args(self):
         # TODO: Extract python arguments to print here.
         # python3.8-dbg.py provides pyop.iter_locals(), though that
@@ -248,34 +415,89 @@ class PythonFrameDecorator(FrameDecorator):
         # inspect.getargvalues is a thing that exists.
         return None
 
-    @StacktraceOnRaise()
+    @stacktrace_on_raise
     def function(self):
         pyframe = self.get_pyframe_argument()
         if pyframe is not None:
-            result = gdb.parse_and_eval(
-                f"PyUnicode_AsUTF8(((PyFrameObject*){pyframe})->f_code->co_name)"
-            )
-            return result.string()
+            _, function, _ = self._read_pyframe(pyframe)
+            return function
 
         if self.pyop is not None:
             return self.pyop.co_name.proxyval(set())
 
         return "Unknown python function"
 
-    @StacktraceOnRaise()
+    @stacktrace_on_raise
     def address(self):
         return None
 
 
-class ElideFilter(FrameFilter, filter_level=FilterLevel.Disabled):
+class CachingFrameProxy(FrameDecorator):
+    """Memoizes the accessors of the wrapped frame
+
+    The elide predicates and gdb's printing of the frame both query
+    the function and filename, and for a PythonFrameDecorator each
+    query may call into the inferior.
+    """
+
+    _unset = object()
+
+    def __init__(self, frame):
+        super().__init__(frame)
+        self._cache = {}
+
+    def _cached(self, key, getter):
+        result = self._cache.get(key, self._unset)
+        if result is self._unset:
+            result = getter()
+            self._cache[key] = result
+        return result
+
+    def filename(self):
+        return self._cached("filename", super().filename)
+
+    def function(self):
+        return self._cached("function", super().function)
+
+    def line(self):
+        return self._cached("line", super().line)
+
+    def address(self):
+        return self._cached("address", super().address)
+
+
+class ElideFilter:
+    """A predicate for frames that should be elided
+
+    Subclasses are not registered with gdb individually.  Instead, all
+    enabled predicates are evaluated by a single CompositeElideFilter,
+    so that each frame's function and filename are only looked up
+    once, rather than once per predicate.
+    """
+
+    _filters = []
+
+    def __init_subclass__(cls, /, filter_level, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.filter_level = filter_level
+        ElideFilter._filters.append(cls)
+
     @abstractmethod
-    def _elide_frame(self, frame: Union[gdb.Frame, FrameDecorator]) -> bool:
+    def _elide_frame(self, function: str, filename: str) -> bool:
         """Whether the frame should be elided.
 
         Return true if the frame should be elided as part of the previous,
         false otherwise.
         """
 
+
+class CompositeElideFilter(
+    FrameFilter,
+    filter_level=(
+        FilterLevel.Pytest | FilterLevel.Dispatch | FilterLevel.CommonBaseClass
+    ),
+    priority=90,
+):
     class ElidedFrameDecorator(FrameDecorator):
         def __init__(self, frame, elided):
             super().__init__(frame)
@@ -284,39 +506,56 @@ class ElideFilter(FrameFilter, filter_level=FilterLevel.Disabled):
         def elided(self):
             return self._elided
 
+    def __init__(self):
+        super().__init__()
+        self.predicates = []
+
+    def configure(self, filter_level):
+        self.predicates = [
+            subclass()._elide_frame
+            for subclass in ElideFilter._filters
+            if filter_level & subclass.filter_level
+        ]
+
+    def _elide_frame(self, frame):
+        function = frame.function()
+        if not isinstance(function, str):
+            function = ""
+
+        filename = frame.filename()
+        if not isinstance(filename, str):
+            filename = ""
+
+        return any(predicate(function, filename) for predicate in self.predicates)
+
+    def _flush(self, prev_nonelided_frame, elided_frames):
+        if prev_nonelided_frame is None:
+            yield from elided_frames
+        elif elided_frames:
+            yield self.ElidedFrameDecorator(prev_nonelided_frame, elided_frames)
+        else:
+            yield prev_nonelided_frame
+
     def filter(self, frame_iter):
+        elide_frame = self._elide_frame
         prev_nonelided_frame = None
         elided_frames = []
 
-        def yield_elided():
-            nonlocal prev_nonelided_frame
-            nonlocal elided_frames
-
-            if elided_frames and prev_nonelided_frame is None:
-                yield from elided_frames
-                elided_frames = []
-            elif elided_frames and prev_nonelided_frame is not None:
-                yield self.ElidedFrameDecorator(prev_nonelided_frame, elided_frames)
-                prev_nonelided_frame = None
-                elided_frames = []
-            elif not elided_frames and prev_nonelided_frame is not None:
-                yield prev_nonelided_frame
-                prev_nonelided_frame = None
-
         for frame in frame_iter:
-            is_elided = self._elide_frame(frame)
-            if is_elided:
+            frame = CachingFrameProxy(frame)
+            if elide_frame(frame):
                 elided_frames.append(frame)
-            else:
-                yield from yield_elided()
-                prev_nonelided_frame = frame
+                continue
 
-        yield from yield_elided()
+            yield from self._flush(prev_nonelided_frame, elided_frames)
+            prev_nonelided_frame = frame
+            elided_frames = []
 
+        yield from self._flush(prev_nonelided_frame, elided_frames)
 
-class PytestFrameFilter(ElideFilter, filter_level=FilterLevel.Pytest, priority=90):
-    def _elide_frame(self, frame):
-        filename = frame.filename()
+
+class PytestFrameFilter(ElideFilter, filter_level=FilterLevel.Pytest):
+    def _elide_frame(self, function, filename):
         for package in ["_pytest", "pluggy"]:
             if f"packages/{package}/" in filename:
                 return True
@@ -325,46 +564,31 @@ class PytestFrameFilter(ElideFilter, filter_level=FilterLevel.Pytest, priority=9
 
 
 class PackedFuncFilter(ElideFilter, filter_level=FilterLevel.Dispatch):
-    def _elide_frame(self, frame):
+    def _elide_frame(self, function, filename):
         packed_func_c_api = (
             "TVMFuncCall(TVMFunctionHandle, TVMValue*, int*, int, TVMValue*, int*)"
         )
-        return (
-            frame.function() == packed_func_c_api or "packed_func.h" in frame.filename()
-        )
+        return function == packed_func_c_api or "packed_func.h" in filename
 
 
 class FunctorDispatchFilter(ElideFilter, filter_level=FilterLevel.Dispatch):
-    def _elide_frame(self, frame):
-        regices = [
-            r"tvm::.*Functor<.*>::operator\(\)",
-            r"tvm::.*Functor<.*>::Visit",
-            r"tvm::.*Functor<.*>::InitVTable",
-            r"tvm::tir::StmtExprVisitor::VisitExpr",
-            r"tvm::tir::StmtExprMutator::VisitExpr",
-        ]
-
-        function = frame.function()
-        return isinstance(function, str) and any(
-            re.search(regex, function) for regex in regices
-        )
+    def _elide_frame(self, function, filename):
+        # Cheap substring check, to avoid running the regex on most frames
+        if "tvm::" not in function:
+            return False
+        return bool(_RE_FUNCTOR.search(function))
 
 
 class TransformationBaseClassFilter(
     ElideFilter, filter_level=FilterLevel.CommonBaseClass
 ):
-    def _elide_frame(self, frame):
-        return frame.function() in [
-            "tvm::tir::transform::PrimFuncPassNode::operator()(tvm::IRModule, tvm::transform::PassContext const&) const",
-            "tvm::transform::Pass::operator()(tvm::IRModule, tvm::transform::PassContext const&) const",
-            "tvm::transform::SequentialNode::operator()(tvm::IRModule, tvm::transform::PassContext const&) const",
-            "tvm::transform::Pass::operator()(tvm::IRModule, tvm::transform::PassContext const&) const",
-            "tvm::transform::Pass::operator()(tvm::IRModule) const",
-        ]
+    def _elide_frame(self, function, filename):
+        return function in _TRANSFORM_BASE_FUNCS
 
 
 class StmtExprVisitorFilter(ElideFilter, filter_level=FilterLevel.CommonBaseClass):
-    def _elide_frame(self, frame):
-        regex = r"(((Expr|Stmt)(Visitor|Mutator))|(IR(Visitor|Mutator)WithAnalyzer))::Visit(Stmt|Expr)_"
-
-        return re.search(regex, frame.function())
+    def _elide_frame(self, function, filename):
+        # Cheap substring check, to avoid running the regex on most frames
+        if "::Visit" not in function:
+            return False
+        return bool(_RE_VISITOR.search(function))
@@ -9,7 +9,12 @@ def import_this_dir():
     name = "tvm_gdb_extensions"
 
     # Re-sourcing the file should reload the extensions, even if
-    # changes have been made.  Therefore, remove python's cache.
+    # changes have been made.  Therefore, unload the previous version
+    # and remove python's cache.
+    prev_mod = sys.modules.get(name)
+    if prev_mod is not None and hasattr(prev_mod, "unload"):
+        prev_mod.unload()
+
     to_remove = [mod_name for mod_name in sys.modules if mod_name.startswith(name)]
     for mod_name in to_remove:
         del sys.modules[mod_name]
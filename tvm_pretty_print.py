@@ -5,21 +5,188 @@
 Usage:
 
 - Source this file in your `.gdbinit`
-  `source ~/path/to/the/tvm_pretty_print.py`
-
-TODO:
-
-- Longer string result from gdb.parse_and_eval, some objects get
-  truncated.
+  `source ~/path/to/the/tvm-gdb-extension/source-me.py`
 
 """
 
+import collections
 import enum
+import functools
 from abc import abstractmethod
 from typing import Optional
 
 import gdb
 
+from .utils import _cached_parse_and_eval, connect_event
+
+
+# Cached results of type lookups.  These depend on the debug symbols
+# that have been loaded, and are invalidated whenever a new objfile is
+# loaded (e.g. TVM being loaded or reloaded).
+_is_objref_by_type_name = {}
+_datatype_layout_by_type_name = {}
+
+
+def _clear_type_caches(event=None):
+    _lookup_type.cache_clear()
+    _object_ref_pointer_type.cache_clear()
+    _is_objref_by_type_name.clear()
+    _datatype_layout_by_type_name.clear()
+
+
+connect_event(gdb.events.new_objfile, _clear_type_caches)
+
+
+# Results of TVM_ObjectRef.to_string, keyed by the address of the
+# ObjectRef.  These are only valid while the inferior is stopped, and
+# are invalidated whenever it runs or its memory is modified, other
+# than by the calls made to generate the strings.  The oldest entries
+# are evicted past _TO_STRING_CACHE_SIZE, as printed IR can be large.
+_TO_STRING_CACHE_SIZE = 4096
+_to_string_cache = collections.OrderedDict()
+_calling_pretty_print = False
+
+
+def _clear_to_string_cache(event=None):
+    if not _calling_pretty_print:
+        _to_string_cache.clear()
+
+
+connect_event(gdb.events.stop, _clear_to_string_cache)
+connect_event(gdb.events.cont, _clear_to_string_cache)
+connect_event(gdb.events.memory_changed, _clear_to_string_cache)
+connect_event(gdb.events.new_objfile, _clear_to_string_cache)
+
+
+# Names of the DataType type codes, matching `tvm.DataType.CODE2STR`.
+_TYPE_CODE_NAMES = {
+    0: "int",
+    1: "uint",
+    2: "float",
+    3: "handle",
+    4: "bfloat",
+    6: "e4m3_float",
+    7: "e5m2_float",
+}
+
+# The tvm python package, imported on first use.  False if it could
+# not be imported.
+_tvm = None
+
+
+def _get_tvm():
+    global _tvm
+    if _tvm is None:
+        try:
+            import tvm
+
+            _tvm = tvm
+        except Exception:
+            # A broken tvm install may raise more than ImportError.
+            # Either way, do not retry the import for every value.
+            _tvm = False
+    return _tvm or None
+
+
+def _custom_type_name(code):
+    # Names of custom datatypes are only known to the tvm registry.
+    tvm = _get_tvm()
+    if tvm is not None:
+        try:
+            return tvm.target.datatype.get_type_name(code)
+        except Exception:
+            pass
+    return str(code)
+
+
+@functools.lru_cache(maxsize=None)
+def _lookup_type(name) -> Optional[gdb.Type]:
+    """Look up a type by name, or None if it is not defined"""
+    try:
+        return gdb.lookup_type(name)
+    except gdb.error:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _object_ref_pointer_type() -> Optional[gdb.Type]:
+    """The `const ObjectRef*` type, or None if TVM is not loaded"""
+    object_ref_type = _lookup_type("::tvm::runtime::ObjectRef")
+    if object_ref_type is None:
+        return None
+    return object_ref_type.const().pointer()
+
+
+def _datatype_layout(type_):
+    """Return the DLDataType field of a DataType, and the DLDataType's fields
+
+    gdb.Type.fields() builds a new list on each call, so the fields
+    are looked up once per type rather than for each value printed.
+    """
+    type_name = type_.strip_typedefs().tag
+    layout = _datatype_layout_by_type_name.get(type_name)
+    if layout is None:
+        data_field = type_.fields()[0]
+        layout = (data_field, {field.name: field for field in data_field.type.fields()})
+        _datatype_layout_by_type_name[type_name] = layout
+    return layout
+
+
+def _derives_from(type_, base) -> bool:
+    """Check if a type is, or is derived from, the base type
+
+    Only inspects the debug symbols, unlike a dynamic_cast, which
+    reads the type information from the inferior.
+    """
+    type_ = type_.strip_typedefs().unqualified()
+    if type_.code != gdb.TYPE_CODE_STRUCT:
+        return False
+
+    if type_ == base:
+        return True
+
+    return any(
+        field.is_base_class and _derives_from(field.type, base)
+        for field in type_.fields()
+    )
+
+
+def _can_lookup_objfile_symbols() -> bool:
+    # Objfile.lookup_global_symbol requires gdb 10 or later
+    return hasattr(gdb.Objfile, "lookup_global_symbol")
+
+
+def _defines_tvm_types(objfile) -> bool:
+    return any(
+        objfile.lookup_global_symbol(name, gdb.SYMBOL_STRUCT_DOMAIN) is not None
+        for name in ["tvm::runtime::ObjectRef", "tvm::runtime::DataType"]
+    )
+
+
+# gdb checks every objfile's printers for each value, so the printers
+# are added once per program space, and only once an objfile that
+# defines TVM types has been loaded.  Sessions without TVM never
+# dispatch to them.
+_enabled_lookups = []
+_registered_progspaces = set()
+
+
+def _register_objfile(objfile):
+    progspace = objfile.progspace
+    if (
+        _enabled_lookups
+        and progspace not in _registered_progspaces
+        and _defines_tvm_types(objfile)
+    ):
+        progspace.pretty_printers.extend(_enabled_lookups)
+        _registered_progspaces.add(progspace)
+
+
+if _can_lookup_objfile_symbols():
+    connect_event(
+        gdb.events.new_objfile, lambda event: _register_objfile(event.new_objfile)
+    )
+
 
 class PrettyPrintLevel(enum.Flag):
     Disabled = 0
@@ -38,9 +205,36 @@ class PrettyPrinter:
 
     @classmethod
     def register(cls, pprint_level):
-        for subclass in cls._printers:
-            if pprint_level & subclass.pprint_level:
-                gdb.pretty_printers.append(subclass.lookup)
+        cls.unregister()
+        _enabled_lookups.extend(
+            subclass.lookup
+            for subclass in cls._printers
+            if pprint_level & subclass.pprint_level
+        )
+        if not _enabled_lookups:
+            return
+
+        if not _can_lookup_objfile_symbols():
+            gdb.pretty_printers.extend(_enabled_lookups)
+            return
+
+        for objfile in gdb.objfiles():
+            _register_objfile(objfile)
+
+    @staticmethod
+    def unregister():
+        """Remove the lookups added by this or any previous register()"""
+        _enabled_lookups.clear()
+        _registered_progspaces.clear()
+
+        def is_own_lookup(lookup):
+            return getattr(lookup, "__module__", None) == __name__
+
+        for printers in [
+            gdb.pretty_printers,
+            *(progspace.pretty_printers for progspace in gdb.progspaces()),
+        ]:
+            printers[:] = [p for p in printers if not is_own_lookup(p)]
 
     @classmethod
     @abstractmethod
@@ -62,47 +256,91 @@ class TVM_ObjectRef(PrettyPrinter, pprint_level=PrettyPrintLevel.ObjectRef):
         else:
             return
 
-        try:
-            object_ref_type = gdb.lookup_type("::tvm::runtime::ObjectRef")
-        except Exception as e:
+        # gdb asks about every value it prints, nearly all of which
+        # are not TVM types.  Reject those by name, before any lookups.
+        type_name = obj.type.strip_typedefs().tag or obj.type.name
+        if type_name is None or not type_name.startswith("tvm::"):
+            return
+
+        object_ref_type = _lookup_type("::tvm::runtime::ObjectRef")
+        if object_ref_type is None:
             # TVM not loaded, so don't use this printer
             return
 
-        ptr_type = object_ref_type.const().pointer()
-        try:
-            as_objref_pointer = obj.address.dynamic_cast(ptr_type)
-            return cls(as_objref_pointer)
-        except gdb.error:
+        # Whether a type derives from ObjectRef is determined from the
+        # debug symbols alone, and only once per type.
+        is_objref = _is_objref_by_type_name.get(type_name)
+        if is_objref is None:
+            is_objref = _derives_from(obj.type, object_ref_type)
+            _is_objref_by_type_name[type_name] = is_objref
+
+        if not is_objref:
             # Not a subclass of ObjectRef, so don't use this printer
             return
 
+        return cls(obj.address.cast(_object_ref_pointer_type()))
+
     def __init__(self, pointer):
         self.pointer = pointer
 
     def to_string(self):
-        command = "::tvm::PrettyPrint(*(::tvm::runtime::ObjectRef*){}).c_str()".format(
-            int(self.pointer)
-        )
+        key = int(self.pointer)
+        output = _to_string_cache.get(key)
+        if output is None:
+            output = self._pretty_print()
+            _to_string_cache[key] = output
+            while len(_to_string_cache) > _TO_STRING_CACHE_SIZE:
+                _to_string_cache.popitem(last=False)
+        return output
+
+    def _pretty_print(self):
+        global _calling_pretty_print
+
         # TODO: Figure out better handling during segfaults, not safe
         # to make calls into tvm at that point.
 
-        # TODO: No string length limit on parse_and_eval
-        output = gdb.parse_and_eval(command)
-        as_str = str(output)
-        parsed = (
-            as_str[as_str.find('"') : as_str.rfind('"') + 1]
-            .encode("ascii")
-            .decode("unicode_escape")
-        )
-        return parsed
+        # Calling the resolved function avoids parsing a new
+        # expression for every value printed.
+        pretty_print = _cached_parse_and_eval("::tvm::PrettyPrint")
+        _calling_pretty_print = True
+        try:
+            result = pretty_print(self.pointer.dereference())
+            # Layout of libstdc++'s std::string.  The pre-C++11 (COW)
+            # ABI has `_M_p`, but no `_M_string_length`.
+            length = None
+            try:
+                c_str = result["_M_dataplus"]["_M_p"]
+            except gdb.error:
+                command = (
+                    "::tvm::PrettyPrint(*(::tvm::runtime::ObjectRef*){}).c_str()"
+                ).format(int(self.pointer))
+                c_str = gdb.parse_and_eval(command)
+            else:
+                try:
+                    length = int(result["_M_string_length"])
+                except gdb.error:
+                    pass
+        finally:
+            _calling_pretty_print = False
+
+        # Read the characters directly, rather than formatting the
+        # gdb.Value and unescaping it.  Formatting the value would
+        # truncate it to `print elements` characters.
+        if length is not None:
+            buf = gdb.selected_inferior().read_memory(int(c_str), length)
+            return bytes(buf).decode("utf-8", errors="replace")
+        else:
+            return c_str.string(encoding="utf-8", errors="replace")
 
 
 class TVM_DataType(PrettyPrinter, pprint_level=PrettyPrintLevel.DataType):
     @classmethod
     def lookup(cls, val):
-        try:
-            datatype_type = gdb.lookup_type("::tvm::runtime::DataType")
-        except Exception as e:
+        if val.type.strip_typedefs().tag != "tvm::runtime::DataType":
+            return
+
+        datatype_type = _lookup_type("::tvm::runtime::DataType")
+        if datatype_type is None:
             # TVM not loaded, so don't use this printer
             return
 
@@ -113,20 +351,24 @@ class TVM_DataType(PrettyPrinter, pprint_level=PrettyPrintLevel.DataType):
         self.val = val
 
     def to_string(self):
-        data = self.val[self.val.type.fields()[0]]
-        data_fields = data.type.fields()
-        values = {
-            field.name: int(data[field].format_string(format="d"))
-            for field in data.type.fields()
-        }
-
-        import tvm
-
-        # Can't construct directly from the type_code/bits/lanes, but
-        # can set them afterwards.
-        dtype = tvm.DataType("int")
-        dtype.type_code = values["code"]
-        dtype.bits = values["bits"]
-        dtype.lanes = values["lanes"]
-
-        return repr(dtype)
+        data_field, data_fields = _datatype_layout(self.val.type)
+        data = self.val[data_field]
+
+        code = int(data[data_fields["code"]])
+        bits = int(data[data_fields["bits"]])
+        lanes = int(data[data_fields["lanes"]])
+
+        # Same formatting as `repr(tvm.DataType)`.  The tvm package
+        # is only needed for the names of custom datatypes.
+        if bits == 1 and lanes == 1:
+            return "bool"
+
+        if code in _TYPE_CODE_NAMES:
+            output = _TYPE_CODE_NAMES[code]
+        else:
+            output = f"custom[{_custom_type_name(code)}]"
+
+        output += str(bits)
+        if lanes != 1:
+            output += "x" + str(lanes)
+        return output
@@ -4,10 +4,72 @@ import traceback
 import gdb
 
 
+# Event handlers connected by this extension.  These are disconnected
+# when the extension is unloaded, so that re-sourcing it does not leave
+# the previous version's handlers connected.
+_CONNECTED_HANDLERS = []
+
+
+def connect_event(registry, handler):
+    """Connect a handler to a gdb event registry, until unloaded"""
+    registry.connect(handler)
+    _CONNECTED_HANDLERS.append((registry, handler))
+
+
+def disconnect_events():
+    """Disconnect all handlers connected through connect_event"""
+    for registry, handler in _CONNECTED_HANDLERS:
+        registry.disconnect(handler)
+    _CONNECTED_HANDLERS.clear()
+
+
+# Maps id(decorator) to (decorator, gdb.Frame).  The decorator is
+# kept alive alongside the result, so that its id cannot be reused
+# until the cache is cleared, before the next prompt or when the
+# inferior stops.
+_UNWRAP_CACHE = {}
+connect_event(gdb.events.before_prompt, _UNWRAP_CACHE.clear)
+connect_event(gdb.events.stop, lambda event: _UNWRAP_CACHE.clear())
+
+
 def _unwrap_frame(frame):
-    while not isinstance(frame, gdb.Frame):
-        frame = frame.inferior_frame()
-    return frame
+    key = id(frame)
+    hit = _UNWRAP_CACHE.get(key)
+    if hit is not None:
+        return hit[1]
+
+    # gdb.Frame has no inferior_frame method, so the first object
+    # without one is the innermost frame.
+    unwrapped = frame
+    while True:
+        inferior_frame = getattr(unwrapped, "inferior_frame", None)
+        if inferior_frame is None:
+            break
+        unwrapped = inferior_frame()
+
+    _UNWRAP_CACHE[key] = (frame, unwrapped)
+    return unwrapped
+
+
+# Results of expressions that only depend on the loaded debug symbols,
+# such as the address of a function.  Cleared whenever a new objfile
+# is loaded.
+_SYMBOL_VALUE_CACHE = {}
+connect_event(gdb.events.new_objfile, lambda event: _SYMBOL_VALUE_CACHE.clear())
+
+
+def _cached_parse_and_eval(expression):
+    """Evaluate an expression once, reusing the result afterwards
+
+    Only suitable for expressions that do not depend on the state of
+    the inferior.  Function values returned from here can be called
+    directly, without going through gdb's expression parser.
+    """
+    value = _SYMBOL_VALUE_CACHE.get(expression)
+    if value is None:
+        value = gdb.parse_and_eval(expression)
+        _SYMBOL_VALUE_CACHE[expression] = value
+    return value
 
 
 class StacktraceOnRaise:
@@ -20,8 +82,11 @@ class StacktraceOnRaise:
     def __call__(self, func):
         @functools.wraps(func)
         def inner(*args, **kwargs):
-            with self:
+            try:
                 return func(*args, **kwargs)
+            except BaseException:
+                traceback.print_exc()
+                raise
 
         return inner
 
@@ -31,3 +96,9 @@ class StacktraceOnRaise:
     def __exit__(self, exc_type, exc_val, exc_traceback):
         if exc_val is not None:
             traceback.print_exc()
+
+
+# StacktraceOnRaise holds no state, so a single instance can be shared
+# by every use, either as `@stacktrace_on_raise` or
+# `with stacktrace_on_raise:`.
+stacktrace_on_raise = StacktraceOnRaise()